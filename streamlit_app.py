@@ -1,17 +1,38 @@
 # streamlit_app.py
+import hashlib
+import json
 import os
+import pickle
+from functools import lru_cache
+from itertools import islice
 import re
-import time
+import orjson
 import requests
 import streamlit as st
 import google.generativeai as genai
-import praw
-from prawcore.exceptions import ResponseException, OAuthException
+from ratelimit import limits, sleep_and_retry
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_random_exponential
 
 # ---------------- App config ----------------
 st.set_page_config(page_title="Reddit Comment Generator", page_icon="💬")
 MODEL_NAME = "gemini-1.5-flash"  # or "gemini-1.5-pro"
 MAX_COMMENTS = 25
+_MAX_BODY = 4000      # chars of selftext sent to Gemini
+_MAX_COMMENT = 500    # chars per comment sent to Gemini
+_TOP_COMMENTS = 15    # highest-scored comments actually summarized
+
+# Shared HTTP session so the TLS connection to Reddit is reused across
+# retries and subsequent uncached fetches instead of re-handshaking.
+# Built behind st.cache_resource: Streamlit re-executes this script on every
+# rerun, so a bare module-level Session would be recreated (and its warm
+# connections dropped) on each interaction.
+@st.cache_resource
+def _http_session():
+    s = requests.Session()
+    s.mount("https://", requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=8))
+    return s
+
+_SESSION = _http_session()
 
 # ---------------- Secrets helper ----------------
 def _get_secret(name, default=None):
@@ -23,94 +44,216 @@ GEMINI_KEY = _get_secret("GOOGLE_API_KEY")
 if not GEMINI_KEY:
     st.error("Missing GOOGLE_API_KEY. Add it in Manage app → Settings → Secrets.")
     st.stop()
-genai.configure(api_key=GEMINI_KEY)
-
-# ---------------- Reddit auth (diagnostic) ----------------
-def _init_reddit():
-    rid = _get_secret("REDDIT_CLIENT_ID")
-    rsec = _get_secret("REDDIT_CLIENT_SECRET")
-    rua = _get_secret("REDDIT_USER_AGENT")
-
-    # Fail early with clear messages
-    missing = [k for k, v in [
-        ("REDDIT_CLIENT_ID", rid),
-        ("REDDIT_CLIENT_SECRET", rsec),
-        ("REDDIT_USER_AGENT", rua),
-    ] if not v]
-    if missing:
-        raise RuntimeError(
-            f"Missing secrets: {', '.join(missing)}. "
-            "Add them in Streamlit → Manage app → Settings → Secrets."
-        )
 
-    try:
-        reddit = praw.Reddit(
-            client_id=rid,
-            client_secret=rsec,
-            user_agent=rua,
-            check_for_async=False,
-        )
-        reddit.read_only = True
-        # Force a tiny authenticated call; raises on bad creds
-        _ = reddit.subreddit("all").display_name
-        return reddit
-    except OAuthException as e:
-        raise RuntimeError(
-            "Reddit OAuth failed (401). Fix one of these:\n"
-            "• App type must be 'script' at reddit.com/prefs/apps.\n"
-            "• client_id must be the SHORT id under the app name (not the app name).\n"
-            "• client_secret must be the LONG secret from the app page.\n"
-            "• user-agent must be like: 'script:comment-generator:1.0 (by /u/YourUser)'."
-        ) from e
-    except ResponseException as e:
-        raise RuntimeError(f"Reddit API refused the request: {e}") from e
-
-# ---------------- Fetch thread via Reddit API ----------------
-@st.cache_data(show_spinner=False, ttl=600)
-def fetch_thread(url: str):
-    if not re.match(r"^https?://", url or ""):
+@st.cache_resource
+def _configure_genai(api_key: str):
+    # SDK setup runs once per process instead of on every script rerun.
+    genai.configure(api_key=api_key)
+    return True
+
+_configure_genai(GEMINI_KEY)
+
+# ---------------- Fetch thread via public .json endpoint ----------------
+TIMEOUT = 10
+_URL_SCHEME = re.compile(r"^https?://")
+_OLD = re.compile(r"^https?://(?:www\.)?reddit\.com")
+_UAS = [
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0 Safari/537.36",
+    "script:reddit-comment-generator:1.0 (Streamlit app)",
+]
+
+# Plain lru_cache: for a tiny pure string op, st.cache_data's pickling
+# machinery would cost more than the work it saves. Returns a tuple so the
+# cached value is immutable.
+@lru_cache(maxsize=256)
+def to_json_url(url: str):
+    if not _URL_SCHEME.match(url or ""):
         raise ValueError("Enter a full Reddit URL starting with http(s)://")
+    base = url.split("?")[0].rstrip("/")
+    base = _OLD.sub("https://old.reddit.com", base)
+    return (base + "/.json?raw_json=1", base + "/.json")
 
-    reddit = _init_reddit()
-    submission = reddit.submission(url=url)
+# 429/5xx raise so tenacity backs off with jitter instead of hammering
+# Reddit in lockstep across users; other statuses fall through to the
+# UA/URL fallback loop below.
+_RETRYABLE = (429, 500, 502, 503, 504)
 
-    # Flatten top-level comments
-    submission.comments.replace_more(limit=0)
-    top_level = submission.comments[:MAX_COMMENTS]
+@retry(
+    wait=wait_random_exponential(multiplier=0.5, max=8),
+    stop=stop_after_attempt(3),
+    retry=retry_if_exception_type(requests.RequestException),
+    reraise=True,
+)
+def _get(url, hdrs):
+    resp = _SESSION.get(url, headers=hdrs, timeout=TIMEOUT, allow_redirects=True)
+    if resp.status_code in _RETRYABLE:
+        raise requests.HTTPError(f"HTTP {resp.status_code} from Reddit", response=resp)
+    return resp
+
+def try_fetch(json_urls):
+    last_err = None
+    for ua in _UAS:
+        hdrs = {"User-Agent": ua}
+        for ju in json_urls:
+            try:
+                resp = _get(ju, hdrs)
+                if resp.status_code == 200:
+                    return resp
+                last_err = RuntimeError(f"Reddit returned HTTP {resp.status_code}")
+            except requests.RequestException as e:
+                last_err = e
+    raise RuntimeError(f"Could not fetch thread JSON: {last_err}")
+
+_POST_ID = re.compile(r"/comments/([a-z0-9]+)")
+
+def _parse_thread(data, source_url):
+    if not isinstance(data, list) or len(data) < 2:
+        raise RuntimeError("Unexpected JSON shape from Reddit.")
+    post = data[0]["data"]["children"][0]["data"]
+    comments_root = data[1]["data"]["children"]
+
+    # Lazily walk the children, keeping score alongside body so the best
+    # comments win the MAX_COMMENTS slots. Scanning a few multiples of the
+    # cap gives the score sort real candidates without traversing
+    # thousand-comment threads end to end.
+    def _iter_comments(children):
+        for c in children:
+            if c.get("kind") != "t1":
+                continue
+            d = c["data"]
+            b = d.get("body", "")
+            if b and b != "[deleted]":
+                yield d.get("score", 0) or 0, b
 
-    comments = []
-    for c in top_level:
-        body = getattr(c, "body", "")
-        if body and body != "[deleted]":
-            comments.append(body)
+    seen = set()
+    scored = []
+    for score, b in islice(_iter_comments(comments_root), MAX_COMMENTS * 4):
+        key = b[:64]
+        if key in seen:  # drop near-identical dupes ("this", bot replies)
+            continue
+        seen.add(key)
+        scored.append((score, b))
+    scored.sort(key=lambda sb: sb[0], reverse=True)
+    comments = [b for _, b in scored[:MAX_COMMENTS]]
 
+    permalink = post.get("permalink", "")
+    author = post.get("author") or "[deleted]"
     return {
-        "title": submission.title or "",
-        "body": submission.selftext or "",
-        "permalink": f"https://www.reddit.com{submission.permalink}",
-        "subreddit": f"r/{submission.subreddit.display_name}",
-        "author": f"u/{submission.author.name}" if submission.author else "[deleted]",
+        "title": post.get("title", ""),
+        "body": post.get("selftext", ""),
+        "permalink": f"https://www.reddit.com{permalink}" if permalink else source_url,
+        "subreddit": f"r/{post.get('subreddit', '')}",
+        "author": f"u/{author}",
         "comments": comments,
     }
 
+@st.cache_data(show_spinner=False, ttl=600, persist="disk", max_entries=256)
+def _fetch_by_id(post_id: str):
+    base = f"https://old.reddit.com/comments/{post_id}"
+    resp = try_fetch([base + "/.json?raw_json=1", base + "/.json"])
+    # orjson parses the raw bytes directly — no utf-8 pre-decode, and a much
+    # faster tokenizer than stdlib json on big nested threads.
+    return _parse_thread(orjson.loads(resp.content), base)
+
+@st.cache_data(show_spinner=False, ttl=600, persist="disk", max_entries=256)
+def _fetch_by_url(url: str):
+    resp = try_fetch(to_json_url(url))
+    return _parse_thread(orjson.loads(resp.content), url)
+
+def fetch_thread(url: str):
+    # Key the cache on the post id when we can extract one, so query-string
+    # and path variants of the same thread share a single entry; odd URL
+    # shapes (short links etc.) fall back to keying on the cleaned URL.
+    if not _URL_SCHEME.match(url or ""):
+        raise ValueError("Enter a full Reddit URL starting with http(s)://")
+    m = _POST_ID.search(url)
+    if m:
+        return _fetch_by_id(m.group(1))
+    return _fetch_by_url(url)
+
 # ---------------- Gemini helpers ----------------
-def g_summary_post(model, title, body):
-    prompt = (
-        "Summarize the Reddit post below in 3–5 sentences. Neutral, specific.\n\n"
-        f"Title: {title}\n\nBody:\n{body}"
-    )
-    return (model.generate_content(prompt).text or "").strip()
+@st.cache_resource
+def get_model(name: str = MODEL_NAME):
+    # One client object per process; reruns and other sessions reuse it.
+    return genai.GenerativeModel(name)
+
+# Warm the singleton during page load so the first Fetch/Generate click
+# doesn't also pay for client construction; cache_resource makes this free
+# on every subsequent rerun.
+get_model()
+
+# Single gate for every Gemini request. Queueing inside our own budget
+# (55/min leaves headroom under the 60 RPM quota) beats bursting past the
+# quota and sitting through the SDK's blind 429 retries.
+@sleep_and_retry
+@limits(calls=55, period=60)
+def _gemini_call(prompt, **kwargs):
+    return get_model().generate_content(prompt, **kwargs)
 
-def g_summary_comments(model, comments):
-    text = "\n\n".join(comments) if comments else "No comments."
+def g_summary_both(title, body, comments):
+    """Summarize post and comments in one request; returns (post, comments)."""
+    # Cap input size so latency and token spend stay bounded on wall-of-text
+    # posts; the tail of a 10k-char rant adds nothing to a 5-sentence summary.
+    body = body[:_MAX_BODY]
+    if not body.strip():
+        # Link/image post: the title is the whole story, so a summary call
+        # would only rephrase it. Template the post half and spend Gemini
+        # tokens on the comments alone (or not at all).
+        post_summary = f"Link/image post titled: {title}".strip()
+        if not comments:
+            return post_summary, ""
+        text = "\n\n".join(c[:_MAX_COMMENT] for c in comments[:_TOP_COMMENTS])
+        prompt = (
+            "Summarize the main viewpoints and recurring advice in these Reddit "
+            "comments. Group similar opinions. Output 4–6 concise bullet points.\n\n"
+            f"{text}"
+        )
+        return post_summary, (_gemini_call(prompt).text or "").strip()
+    if not comments:
+        # Fresh thread with nothing to summarize — don't spend tokens asking
+        # the model to tell us so.
+        prompt = (
+            "Summarize the Reddit post below in 3–5 sentences. Neutral, specific.\n\n"
+            f"Title: {title}\n\nBody:\n{body}"
+        )
+        return (_gemini_call(prompt).text or "").strip(), ""
+    text = "\n\n".join(c[:_MAX_COMMENT] for c in comments[:_TOP_COMMENTS])
     prompt = (
-        "Summarize the main viewpoints and recurring advice in these Reddit comments. "
-        "Group similar opinions. Output 4–6 concise bullet points.\n\n"
-        f"{text}"
+        "You will summarize a Reddit thread. Respond in JSON with exactly two "
+        'string keys: {"post": "...", "comments": "..."}.\n'
+        '- "post": summarize the post in 3–5 sentences. Neutral, specific.\n'
+        '- "comments": summarize the main viewpoints and recurring advice in '
+        "the comments. Group similar opinions. 4–6 concise bullet points.\n\n"
+        f"Title: {title}\n\nBody:\n{body}\n\nComments:\n{text}"
     )
-    return (model.generate_content(prompt).text or "").strip()
+    response = _gemini_call(
+        prompt,
+        generation_config={"response_mime_type": "application/json"},
+    )
+    parsed = json.loads(response.text or "{}")
+    return (parsed.get("post", "") or "").strip(), (parsed.get("comments", "") or "").strip()
+
+def _digest(*parts):
+    h = hashlib.blake2b(digest_size=16)
+    for p in parts:
+        h.update(p.encode("utf-8", "replace"))
+        h.update(b"\x00")
+    return h.hexdigest()
 
-def g_generate_reply(model, url, tone, words, post_summary, comments_summary):
+@st.cache_data(show_spinner=False, ttl=3600, persist="disk", max_entries=512)
+def _cached_summaries(content_hash: str, _title, _body, _comments):
+    # Underscore args are excluded from the cache key, so the entry is keyed
+    # purely on the content digest: crossposts and URL variants with the same
+    # text share one completion, and the lookup hashes a 32-char string
+    # instead of pickling the whole thread.
+    return g_summary_both(_title, _body, _comments)
+
+def cached_summaries(title, body, comments):
+    # Disk persistence means a re-fetched thread skips Gemini entirely,
+    # even across container restarts.
+    return _cached_summaries(_digest(title, body, *comments), title, body, comments)
+
+def _reply_prompt(url, tone, words, post_summary, comments_summary):
     vibe = {
         "Neutral": "balanced, conversational",
         "Informative": "explains with 2–4 concrete steps or facts",
@@ -118,7 +261,7 @@ def g_generate_reply(model, url, tone, words, post_summary, comments_summary):
         "Supportive": "empathetic, encouraging, practical",
     }.get(tone, "conversational")
 
-    prompt = (
+    return (
         f"Write a Reddit-style comment for the thread: {url}\n"
         f"Tone: {tone} ({vibe}). Target length ~{words} words.\n"
         "Guidelines:\n"
@@ -127,28 +270,109 @@ def g_generate_reply(model, url, tone, words, post_summary, comments_summary):
         "- If advising, include 2–4 realistic steps.\n"
         "- No emojis, hashtags, links, or disclaimers.\n\n"
         f"POST SUMMARY:\n{post_summary}\n\n"
-        f"COMMENT THEMES:\n{comments_summary}\n\n"
-        "Now draft the reply."
+        + (f"COMMENT THEMES:\n{comments_summary}\n\n" if comments_summary else "")
+        + "Now draft the reply."
+    )
+
+def g_generate_reply(url, tone, words, post_summary, comments_summary):
+    """Yield reply text chunks as Gemini streams them."""
+    prompt = _reply_prompt(url, tone, words, post_summary, comments_summary)
+    # Stream so perceived latency is time-to-first-token, not last.
+    for chunk in _gemini_call(prompt, stream=True):
+        if chunk.text:
+            yield chunk.text
+
+def g_generate_replies(url, tone, words, post_summary, comments_summary, n):
+    """Get n alternative replies from one request via candidate_count."""
+    prompt = _reply_prompt(url, tone, words, post_summary, comments_summary)
+    response = _gemini_call(
+        prompt,
+        generation_config=genai.types.GenerationConfig(candidate_count=n, temperature=0.9),
     )
-    return (model.generate_content(prompt).text or "").strip()
+    replies = []
+    for cand in response.candidates:
+        text = "".join(part.text for part in cand.content.parts).strip()
+        if text:
+            replies.append(text)
+    return replies
+
+@st.cache_data(show_spinner=False, ttl=24 * 60 * 60, max_entries=256)
+def cached_replies(permalink, tone, words, post_summary, comments_summary, n, nonce):
+    # Identical inputs (same thread, tone, length) reuse the completion for
+    # free; the nonce distinguishes successive batches so Generate Another
+    # can still draw fresh samples past the first pool.
+    return g_generate_replies(permalink, tone, words, post_summary, comments_summary, n)
+
+# ---------------- Shared session state (optional Redis) ----------------
+# With several load-balanced replicas, st.session_state is per-worker: when a
+# sticky session breaks, summaries and replies are lost and the user pays for
+# a full re-fetch + re-summarize. If REDIS_HOST is configured, mirror the
+# expensive state there keyed by Streamlit session id; without it the app
+# behaves exactly as before.
+_SHARED_KEYS = ("post_summary", "comments_summary", "permalink", "replies", "reply_pool")
 
-def generate_new_option(permalink, tone, words, post_summary, comments_summary):
-    model = genai.GenerativeModel(MODEL_NAME)
-    return g_generate_reply(model, permalink, tone, words, post_summary, comments_summary)
+@st.cache_resource
+def _redis_client():
+    host = _get_secret("REDIS_HOST")
+    if not host:
+        return None
+    try:
+        import redis
+        client = redis.Redis(host=host, port=int(_get_secret("REDIS_PORT", 6379)))
+        client.ping()
+        return client
+    except Exception:
+        return None
+
+def _state_key():
+    try:
+        from streamlit.runtime.scriptrunner import get_script_run_ctx
+        ctx = get_script_run_ctx()
+        return f"rcg:state:{ctx.session_id}" if ctx else None
+    except Exception:
+        return None
+
+def _restore_state():
+    client, key = _redis_client(), _state_key()
+    if client is None or key is None:
+        return
+    try:
+        raw = client.get(key)
+    except Exception:
+        return
+    if raw:
+        saved = pickle.loads(raw)
+        for k in _SHARED_KEYS:
+            if k in saved and k not in st.session_state:
+                st.session_state[k] = saved[k]
+
+def _save_state():
+    client, key = _redis_client(), _state_key()
+    if client is None or key is None:
+        return
+    try:
+        client.setex(key, 3600, pickle.dumps({k: st.session_state.get(k) for k in _SHARED_KEYS}))
+    except Exception:
+        pass
 
 # ---------------- UI ----------------
 st.title("Reddit Comment Generator")
 
-url = st.text_input("Enter a Reddit post URL")
-
-tone = st.radio(
-    "What's the vibe? Choose your comment's tone:",
-    ["Neutral", "Informative", "Humorous", "Supportive"],
-    index=0,
-)
-length = st.slider("Target length (words)", 50, 220, 100)
+# Batch the inputs in a form: dragging a slider or switching the tone no
+# longer reruns the whole script — only the submit click does.
+with st.form("inputs"):
+    url = st.text_input("Enter a Reddit post URL")
+    tone = st.radio(
+        "What's the vibe? Choose your comment's tone:",
+        ["Neutral", "Informative", "Humorous", "Supportive"],
+        index=0,
+    )
+    length = st.slider("Target length (words)", 50, 220, 100)
+    num_options = st.slider("Number of options per click", 1, 5, 3)
+    fetch_btn = st.form_submit_button("Fetch & Summarize")
 
 # Session state
+_restore_state()
 if "post_summary" not in st.session_state:
     st.session_state.post_summary = ""
 if "comments_summary" not in st.session_state:
@@ -157,28 +381,68 @@ if "permalink" not in st.session_state:
     st.session_state.permalink = ""
 if "replies" not in st.session_state:
     st.session_state.replies = []
+if "reply_pool" not in st.session_state:
+    st.session_state.reply_pool = []
 
-col1, col2 = st.columns([1, 1])
-with col1:
-    fetch_btn = st.button("Fetch & Summarize")
-with col2:
-    gen_btn = st.button("Generate Comment", disabled=not bool(st.session_state.post_summary))
+gen_btn = st.button("Generate Comment", disabled=not bool(st.session_state.post_summary))
+
+# Replies are produced in batches via candidate_count: all options of a
+# batch cost one request, and later clicks are served from the pool with
+# no network call at all.
+def _fetch_batch():
+    with st.spinner("Generating..."):
+        return cached_replies(
+            st.session_state.permalink,
+            tone,
+            length,
+            st.session_state.post_summary,
+            st.session_state.comments_summary,
+            num_options,
+            nonce=len(st.session_state.replies),
+        )
+
+def _stream_single():
+    # Render tokens as they arrive; the caller re-renders the final text.
+    placeholder = st.empty()
+    full = placeholder.write_stream(
+        g_generate_reply(
+            st.session_state.permalink,
+            tone,
+            length,
+            st.session_state.post_summary,
+            st.session_state.comments_summary,
+        )
+    )
+    placeholder.empty()
+    return (full or "").strip()
+
+def _next_reply():
+    pool = st.session_state.reply_pool
+    if pool:
+        return pool.pop(0)
+    if num_options == 1:
+        return _stream_single()
+    pool.extend(_fetch_batch())
+    return pool.pop(0) if pool else ""
 
 if fetch_btn:
     if not url:
         st.warning("Paste a full Reddit post link.")
     else:
         try:
-            with st.spinner("Fetching thread via Reddit API..."):
+            with st.spinner("Fetching thread..."):
                 thread = fetch_thread(url)
             st.session_state.permalink = thread["permalink"]
 
-            model = genai.GenerativeModel(MODEL_NAME)
-            st.session_state.post_summary = g_summary_post(model, thread["title"], thread["body"])
-            st.session_state.comments_summary = g_summary_comments(model, thread["comments"])
+            (
+                st.session_state.post_summary,
+                st.session_state.comments_summary,
+            ) = cached_summaries(thread["title"], thread["body"], tuple(thread["comments"]))
 
             st.success("Summaries ready. Now generate a comment.")
             st.session_state.replies = []
+            st.session_state.reply_pool = []
+            _save_state()
         except Exception as e:
             st.error(f"Error fetching Reddit: {e}")
 
@@ -186,30 +450,31 @@ if st.session_state.post_summary:
     with st.expander("Post Summary", expanded=True):
         st.write(st.session_state.post_summary)
     with st.expander("Comments Summary", expanded=True):
-        st.write(st.session_state.comments_summary)
+        st.write(st.session_state.comments_summary or "(No top-level comments yet.)")
 
 if gen_btn:
-    reply = generate_new_option(
-        st.session_state.permalink,
-        tone,
-        length,
-        st.session_state.post_summary,
-        st.session_state.comments_summary,
-    )
-    if reply:
-        st.session_state.replies.append(reply)
+    # First click: surface the whole batch at once so the user can compare
+    # options side by side; they all came from the same single request.
+    # A batch of one streams instead, so reading starts at first token.
+    if num_options == 1:
+        reply = _stream_single()
+        batch = [reply] if reply else []
+    else:
+        batch = _fetch_batch()
+    if batch:
+        st.session_state.replies.extend(batch)
+        _save_state()
 
 if st.session_state.replies:
-    st.markdown("### Suggested Comments")
-    for i, r in enumerate(st.session_state.replies, 1):
-        st.markdown(f"**Option {i}:**\n\n{r}\n")
+    # One markdown element instead of one per reply — a single protobuf
+    # message over the websocket and one DOM node for Streamlit to diff.
+    md = "### Suggested Comments\n\n" + "\n\n".join(
+        f"**Option {i}:**\n\n{r}" for i, r in enumerate(st.session_state.replies, 1)
+    )
+    st.markdown(md)
     if st.button("Generate Another"):
-        reply = generate_new_option(
-            st.session_state.permalink,
-            tone,
-            length,
-            st.session_state.post_summary,
-            st.session_state.comments_summary,
-        )
+        reply = _next_reply()
         if reply:
+            st.markdown(f"**Option {len(st.session_state.replies) + 1}:**\n\n{reply}\n")
             st.session_state.replies.append(reply)
+            _save_state()